@@ -1,119 +1,339 @@
 import logging
 from pathlib import Path
 import os
+import re
+import runpy
 import subprocess
+import sys
+import tempfile
+from safetensors import safe_open
 
 # Import setup_llama_cpp
 from setup_llama_cpp import SetupLLamaCpp
+from extract_components import advise_file, classify_key
+
+# Prefix of the UNet weights inside a full SDXL checkpoint, stripped in the GGUF like convert.py does
+UNET_PREFIX = "model.diffusion_model."
+
+# F32/BF16 tensors with at most this many parameters stay F32, matching convert.py
+F32_PARAM_THRESHOLD = 1024
+
+# Tensors with at least this many parameters are reshaped to rows of 256 when
+# their last dimension is not a multiple of 256, matching convert.py for SDXL
+REARRANGE_THRESHOLD = 512
 
 class ConvertAndQuantize:
     def __init__(self, model_path):
         self.model_path = model_path
         self.gguf_dir = Path(model_path).parent / "gguf"
-        self.gguf_dir.mkdir(exist_ok=True)
+        self.gguf_dir.mkdir(exist_ok=True, parents=True)
         self.quantized_dir = Path(model_path).parent / "quantized"
-        self.quantized_dir.mkdir(exist_ok=True)
+        self.quantized_dir.mkdir(exist_ok=True, parents=True)
         self.llama_cpp = SetupLLamaCpp()
+        self._quantize_bin = None
+        self._quantize_usage = None
+        self._convert_accepts_outtype = None
 
-    def convert_to_gguf(self, unet_path, setup_llama_cpp=True):
+    def _is_bf16(self, f, keys):
+        """Check whether most multi-dimensional weights among keys of an open safetensors file are BF16"""
+        dtype_counts = {}
+        for key in keys:
+            tensor_slice = f.get_slice(key)
+            if len(tensor_slice.get_shape()) > 1:
+                dtype = tensor_slice.get_dtype()
+                dtype_counts[dtype] = dtype_counts.get(dtype, 0) + 1
+        return bool(dtype_counts) and max(dtype_counts, key=dtype_counts.get) == "BF16"
+
+    def _convert_supports_outtype(self, convert_script):
+        """Check whether convert.py's argument parser defines --outtype, looked up once per instance"""
+        if self._convert_accepts_outtype is None:
+            # Ask the parser itself: the word may also appear in comments or help text
+            result = subprocess.run([sys.executable, convert_script, "--help"], capture_output=True, text=True)
+            self._convert_accepts_outtype = bool(re.search(r"^\s+(?:-\w+(?: \w+)?, )?--outtype\b", result.stdout, re.MULTILINE))
+        return self._convert_accepts_outtype
+    
+    def convert_to_gguf(self, unet_path, setup_llama_cpp=True, force_setup=False):
         """Convert UNet to GGUF format"""
         if setup_llama_cpp:
-            self.llama_cpp.setup_llama_cpp()
+            self.llama_cpp.setup_llama_cpp(force=force_setup)
         
         unet_path = Path(unet_path)
         if not unet_path.exists():
-            logging.error(f"UNet file not found: {unet_path}")
+            logging.error("UNet file not found: %s", unet_path)
             return None
             
         filename_prefix = unet_path.stem.replace("_unet", "")
-        logging.info(f"Converting UNet to GGUF: {unet_path}")
+        logging.info("Converting UNet to GGUF: %s", unet_path)
         
         # Make output directory if it doesn't exist
         self.gguf_dir.mkdir(exist_ok=True)
         
-        # Output path for the GGUF file
-        output_path = self.gguf_dir / f"{filename_prefix}-F16.gguf"
-        
-        # Navigate to llama.cpp directory
-        original_dir = os.getcwd()
         try:
+            # Keep BF16 weights in BF16: going through F16 would clip their range
+            with safe_open(str(unet_path), framework="pt") as f:
+                is_bf16 = self._is_bf16(f, f.keys())
+            outtype = "BF16" if is_bf16 else "F16"
+            
+            # Output path for the GGUF file
+            output_path = self.gguf_dir / f"{filename_prefix}-{outtype}.gguf"
+            
             # Get absolute paths
             unet_abs_path = os.path.abspath(str(unet_path))
             output_abs_path = os.path.abspath(str(output_path))
             
-            # Approach 1: Use a shell command directly with explicit architecture
-            cmd_str = f'python llama.cpp/convert.py --src "{unet_abs_path}" --dst "{output_abs_path}"'
-            logging.info(f"Running command: {cmd_str}")
+            # Run convert.py inside this interpreter so torch/safetensors/gguf
+            # stay imported across calls and errors surface as exceptions
+            convert_script = os.path.abspath(os.path.join("llama.cpp", "convert.py"))
+            convert_args = ["--src", unet_abs_path, "--dst", output_abs_path]
+            # Older convert.py versions have no --outtype and pick the type themselves
+            if self._convert_supports_outtype(convert_script):
+                convert_args += ["--outtype", outtype.lower()]
+            logging.info("Running conversion: %s %s", convert_script, ' '.join(convert_args))
             
+            original_argv = sys.argv
+            sys.argv = [convert_script] + convert_args
             try:
-                # Try using os.system first
-                exit_code = os.system(cmd_str)
-                if exit_code != 0:
-                    raise RuntimeError(f"Command exited with code {exit_code}")
-            except Exception as e1:
-                logging.warning(f"First conversion attempt failed: {e1}")
+                runpy.run_path(convert_script, run_name="__main__")
+            except SystemExit as e:
+                if e.code not in (None, 0):
+                    raise RuntimeError(f"Conversion script exited with code {e.code}")
+            finally:
+                sys.argv = original_argv
         except Exception as e:
-            logging.error(f"Conversion attempts have failed: {e}")
+            logging.error("Conversion attempts have failed: %s", e)
             return None
-        finally:
-            os.chdir(original_dir)
         
         # Check if output file was created
         if not output_path.exists():
             logging.error("Conversion failed: Output file not created")
             return None
             
-        logging.info(f"GGUF conversion complete. Output saved to: {output_path}")
+        logging.info("GGUF conversion complete. Output saved to: %s", output_path)
         return str(output_path)
     
+    def fused_extract_and_convert(self, model_path, setup_llama_cpp=True, force_setup=False):
+        """
+        Convert the UNet of a full SDXL checkpoint straight to GGUF.
+        
+        Skips writing the intermediate UNet safetensors file: tensors are read
+        from the memory-mapped checkpoint and streamed into the GGUF one at a time.
+        The tensor types and the SDXL reshape (with its comfy.gguf.orig_shape
+        metadata) are copied from handle_tensors in city96's convert.py, so
+        llama-quantize treats the output like a regular convert.py GGUF.
+        """
+        if setup_llama_cpp:
+            self.llama_cpp.setup_llama_cpp(force=force_setup)
+        
+        # Imported here since gguf-py is installed by the llama.cpp setup
+        import gguf
+        import torch
+        
+        model_path = Path(model_path)
+        if not model_path.exists():
+            logging.error("Model file not found: %s", model_path)
+            return None
+        
+        self.gguf_dir.mkdir(exist_ok=True)
+        
+        output_path = None
+        writer = None
+        created = False
+        try:
+            with safe_open(str(model_path), framework="pt") as f:
+                unet_keys = [key for key in f.keys() if classify_key(key)[0] == "unet"]
+                # Keep only the diffusion model weights, as convert.py does
+                if any(key.startswith(UNET_PREFIX) for key in unet_keys):
+                    key_map = [(key, key[len(UNET_PREFIX):]) for key in unet_keys if key.startswith(UNET_PREFIX)]
+                else:
+                    key_map = [(key, key) for key in unet_keys]
+                
+                # Keep BF16 weights in BF16: going through F16 would clip their range
+                if self._is_bf16(f, [src_key for src_key, _ in key_map]):
+                    outtype = "BF16"
+                    half_dtype = (torch.bfloat16, gguf.GGMLQuantizationType.BF16, 2)
+                    file_type = gguf.LlamaFileType.MOSTLY_BF16
+                else:
+                    outtype = "F16"
+                    half_dtype = (torch.float16, gguf.GGMLQuantizationType.F16, 2)
+                    file_type = gguf.LlamaFileType.MOSTLY_F16
+                
+                output_path = self.gguf_dir / f"{model_path.stem}-{outtype}.gguf"
+                logging.info("Converting UNet of %s directly to GGUF: %s", model_path, output_path)
+                
+                writer = gguf.GGUFWriter(str(output_path), arch="sdxl")
+                writer.add_quantization_version(gguf.GGML_QUANT_VERSION)
+                writer.add_file_type(file_type)
+                
+                # Register every tensor up front from the header metadata so the
+                # data can then be written without holding the UNet in memory
+                target_dtypes = {}
+                target_shapes = {}
+                for src_key, dst_key in key_map:
+                    tensor_slice = f.get_slice(src_key)
+                    shape = tensor_slice.get_shape()
+                    n_params = 1
+                    for dim in shape:
+                        n_params *= dim
+                    # Only full-precision sources keep their small tensors in F32
+                    if tensor_slice.get_dtype() in ("F32", "BF16") and (len(shape) <= 1 or n_params <= F32_PARAM_THRESHOLD):
+                        target_dtypes[src_key] = (torch.float32, gguf.GGMLQuantizationType.F32, 4)
+                    else:
+                        target_dtypes[src_key] = half_dtype
+                    
+                    # K-quants work on rows of 256, so flatten conv weights and the like into
+                    # such rows and record the original shape for the loader to restore
+                    if (len(shape) > 1 and n_params >= REARRANGE_THRESHOLD
+                            and n_params % 256 == 0 and shape[-1] % 256 != 0):
+                        writer.add_array(f"comfy.gguf.orig_shape.{dst_key}", [int(dim) for dim in shape])
+                        shape = [n_params // 256, 256]
+                    target_shapes[src_key] = shape
+                    
+                    _, qtype, itemsize = target_dtypes[src_key]
+                    writer.add_tensor_info(dst_key, shape, None, n_params * itemsize, raw_dtype=qtype)
+                
+                # From here on the writer truncates output_path
+                created = True
+                writer.write_header_to_file()
+                writer.write_kv_data_to_file()
+                writer.write_ti_data_to_file()
+                for src_key, _ in key_map:
+                    torch_dtype = target_dtypes[src_key][0]
+                    tensor = f.get_tensor(src_key).to(torch_dtype).reshape(target_shapes[src_key])
+                    # numpy has no bfloat16, so hand the raw 16-bit words to the writer
+                    if torch_dtype == torch.bfloat16:
+                        tensor = tensor.view(torch.int16)
+                    writer.write_tensor_data(tensor.numpy())
+        except Exception as e:
+            logging.error("Fused conversion failed: %s", e)
+            # Don't leave a truncated GGUF behind for a later --skip_convert run to pick
+            # up, but keep one from an earlier run if this call never touched it
+            if created and output_path.exists():
+                output_path.unlink()
+            return None
+        finally:
+            if writer is not None:
+                writer.close()
+        
+        logging.info("GGUF conversion complete. Output saved to: %s", output_path)
+        return str(output_path)
+    
+    def _find_quantize_bin(self):
+        """Return the absolute path of the llama-quantize binary, looked up once per instance"""
+        if self._quantize_bin is not None:
+            return self._quantize_bin
+        for candidate in ["llama.cpp/build/bin/llama-quantize", "llama.cpp/build/llama-quantize"]:
+            quantize_bin = os.path.abspath(candidate)
+            if os.path.exists(quantize_bin):
+                self._quantize_bin = quantize_bin
+                return quantize_bin
+        raise FileNotFoundError(f"llama-quantize binary not found at {quantize_bin}")
+    
+    def prefetch_gguf(self, gguf_path):
+        """
+        Ask the kernel to pull a GGUF file into the page cache.
+        
+        llama-quantize has no mode that writes several quant types in one run,
+        so each quant type reads the source again; prefetching it once keeps
+        those reads in memory. No-op where posix_fadvise is unavailable.
+        """
+        advise_file(gguf_path, "POSIX_FADV_WILLNEED")
+    
+    def _supports_option(self, option):
+        """Check whether the llama-quantize binary lists a command line option in its usage text"""
+        if self._quantize_usage is None:
+            # llama-quantize prints its usage and exits non-zero on --help
+            result = subprocess.run([self._find_quantize_bin(), "--help"], capture_output=True, text=True)
+            self._quantize_usage = result.stdout + result.stderr
+        return option in self._quantize_usage
+    
+    def supports_mixed_quantization(self):
+        """
+        Check whether the llama-quantize build accepts per-tensor quantization types.
+        
+        The pinned llama.cpp release predates --tensor-type-file, so this needs
+        llama.cpp rebuilt from a newer release.
+        
+        Raises:
+            FileNotFoundError: If llama-quantize has not been built
+        """
+        return self._supports_option("--tensor-type-file")
+    
     def quantize_gguf(self, gguf_path, quant_type):
         """Quantize a GGUF model to the specified quantization type"""
+        return self._quantize(gguf_path, quant_type)
+    
+    def quantize_gguf_mixed(self, gguf_path, default_quant, overrides):
+        """
+        Quantize a GGUF model in a single pass with per-tensor quantization types.
+        
+        Args:
+            gguf_path: Path to the F16/BF16 GGUF model
+            default_quant: Quantization type for tensors not matched by an override
+            overrides: Mapping of tensor name pattern to quantization type, e.g.
+                {"time_embed": "Q8_0"} to keep sensitive layers at higher precision
+            
+        Returns:
+            Path to the quantized model, or None on failure
+        """
+        try:
+            if not self.supports_mixed_quantization():
+                logging.error("This llama-quantize build does not support --tensor-type-file; "
+                              "rebuild llama.cpp from a newer release for mixed quantization")
+                return None
+        except FileNotFoundError as e:
+            logging.error("Quantization failed: %s", e)
+            return None
+        
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", prefix="tensor-types-", delete=False) as f:
+            for pattern, quant_type in overrides.items():
+                f.write(f"{pattern}={quant_type}\n")
+            tensor_type_file = f.name
+        try:
+            return self._quantize(gguf_path, default_quant, "_mixed", ["--tensor-type-file", tensor_type_file])
+        finally:
+            os.remove(tensor_type_file)
+    
+    def _quantize(self, gguf_path, quant_type, name_suffix="", extra_args=()):
+        """Run llama-quantize on a GGUF model, writing <name>_<quant_type><name_suffix>.gguf"""
         gguf_path = Path(gguf_path)
         gguf_abs_path = os.path.abspath(str(gguf_path))
         
         if not os.path.exists(gguf_abs_path):
-            logging.error(f"Source GGUF file not found: {gguf_abs_path}")
+            logging.error("Source GGUF file not found: %s", gguf_abs_path)
             return None
             
-        base_name = gguf_path.stem.replace("-F16", "")
-        self.quantized_dir.mkdir(exist_ok=True)
-        dst = self.quantized_dir / f"{base_name}_{quant_type}.gguf"
+        base_name = gguf_path.stem
+        for suffix in ("-F16", "-BF16"):
+            if base_name.endswith(suffix):
+                base_name = base_name[:-len(suffix)]
+                break
+        dst = self.quantized_dir / f"{base_name}_{quant_type}{name_suffix}.gguf"
         dst_abs_path = os.path.abspath(str(dst))
         
-        # Navigate to llama.cpp directory
-        original_dir = os.getcwd()
         try:
-            os.chdir("llama.cpp")
-            
-            # Find the quantize binary
-            quantize_bin = "./build/bin/llama-quantize"
-            if not os.path.exists(quantize_bin):
-                quantize_bin = "./build/llama-quantize"  # Alternative path
-                
-            if not os.path.exists(quantize_bin):
-                raise FileNotFoundError(f"llama-quantize binary not found at {quantize_bin}")
+            # Invoke the binary by absolute path instead of changing directory,
+            # which is process-wide and would race with concurrent quantizations
+            quantize_bin = self._find_quantize_bin()
             
             # Run quantization with absolute paths
-            cmd = [quantize_bin, gguf_abs_path, dst_abs_path, quant_type]
+            cmd = [quantize_bin, *extra_args, gguf_abs_path, dst_abs_path, quant_type]
             
-            logging.info(f"Running quantization: {' '.join(cmd)}")
+            logging.info("Running quantization: %s", ' '.join(cmd))
             result = subprocess.run(cmd, check=True, capture_output=True, text=True)
             
             if result.stdout:
-                logging.info(f"Quantization output: {result.stdout}")
+                logging.info("Quantization output: %s", result.stdout)
             if result.stderr:
-                logging.warning(f"Quantization stderr: {result.stderr}")
+                logging.warning("Quantization stderr: %s", result.stderr)
                 
         except subprocess.CalledProcessError as e:
-            logging.error(f"Quantization failed: {e}")
-            logging.error(f"Command error: {e.stderr if hasattr(e, 'stderr') else 'No error info'}")
+            logging.error("Quantization failed: %s", e)
+            logging.error("Command error: %s", e.stderr if hasattr(e, 'stderr') else 'No error info')
             return None
-        finally:
-            os.chdir(original_dir)
         
         if not dst.exists():
             logging.error("Quantization failed: Output file not created")
             return None
             
-        logging.info(f"Quantization complete. Output saved to: {dst}")
+        logging.info("Quantization complete. Output saved to: %s", dst)
         return str(dst)
@@ -1,14 +1,62 @@
 import os
+import json
+import hashlib
 import logging
+import shutil
 import subprocess
+import urllib.request
 from pathlib import Path
 
+# Read size used when hashing a download
+HASH_CHUNK_SIZE = 4 * 1024 * 1024
+
 class CivitaiDownloader:
     def __init__(self, output_dir="./downloads"):
         """Initialize the downloader with an output directory."""
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(exist_ok=True, parents=True)
         
+    def get_expected_sha256(self, model_version_id, civitai_token):
+        """
+        Look up the SHA-256 of the primary file of a model version from the CivitAI API.
+        
+        Returns:
+            Lowercase hex digest, or None if it could not be retrieved
+        """
+        api_url = f"https://civitai.com/api/v1/model-versions/{model_version_id}"
+        request = urllib.request.Request(api_url, headers={"Authorization": f"Bearer {civitai_token}"})
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                metadata = json.load(response)
+        except Exception as e:
+            logging.warning("Could not fetch model metadata from CivitAI: %s", e)
+            return None
+        
+        files = metadata.get("files") or []
+        primary = next((f for f in files if f.get("primary")), files[0] if files else None)
+        sha256 = (primary or {}).get("hashes", {}).get("SHA256")
+        return sha256.lower() if sha256 else None
+    
+    def _sha256_file(self, path):
+        """Hash a file that was written by an external downloader"""
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                h.update(chunk)
+        return h.hexdigest()
+    
+    def _wget_and_hash(self, file_url, output_file_path):
+        """Download with wget to stdout, hashing the bytes while writing them to disk"""
+        h = hashlib.sha256()
+        cmd = ["wget", "-q", "--show-progress", file_url, "-O", "-"]
+        with subprocess.Popen(cmd, stdout=subprocess.PIPE) as p, open(output_file_path, "wb") as out:
+            while chunk := p.stdout.read(HASH_CHUNK_SIZE):
+                h.update(chunk)
+                out.write(chunk)
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, cmd)
+        return h.hexdigest()
+        
     def download_model(self, model_name, model_version_id, civitai_token):
         """
         Download a model from CivitAI using the provided version ID and API token.
@@ -29,15 +77,40 @@ class CivitaiDownloader:
         # Construct the download URL with version ID and token
         file_url = f"https://civitai.com/api/download/models/{model_version_id}?token={civitai_token}"
         
-        logging.info(f"Downloading model from CivitAI: {model_name}")
-        logging.info(f"Output path: {output_file_path}")
+        logging.info("Downloading model from CivitAI: %s", model_name)
+        logging.info("Output path: %s", output_file_path)
+        
+        expected_sha256 = self.get_expected_sha256(model_version_id, civitai_token)
         
-        # Download the file using wget
+        # Download the file with aria2c when available, since the CivitAI CDN
+        # throttles per connection; otherwise fall back to a single wget stream
+        # that is hashed as it is written
+        use_aria2c = shutil.which("aria2c") is not None
         try:
-            cmd = ["wget", "-c", file_url, "-O", str(output_file_path)]
-            subprocess.run(cmd, check=True)
-            logging.info(f"Model downloaded successfully to: {output_file_path}")
-            return str(output_file_path)
+            if use_aria2c:
+                cmd = ["aria2c", "-x", "8", "-s", "8", "-k", "4M", "-c",
+                       "-o", model_name, "-d", str(self.output_dir), file_url]
+                subprocess.run(cmd, check=True)
+                # aria2c writes out of order, so hash afterwards while the file is still in page cache
+                sha256 = self._sha256_file(output_file_path) if expected_sha256 else None
+            else:
+                sha256 = self._wget_and_hash(file_url, output_file_path)
         except subprocess.CalledProcessError as e:
-            logging.error(f"Failed to download model: {e}")
-            return None 
\ No newline at end of file
+            logging.error("Failed to download model: %s", e)
+            # aria2c resumes its own partial file with -c, but a truncated wget
+            # download can't be resumed and would look like a complete model
+            if not use_aria2c and output_file_path.exists():
+                os.remove(output_file_path)
+            return None
+        
+        if expected_sha256 is None:
+            logging.warning("No SHA-256 available from CivitAI, skipping integrity check")
+        elif sha256 != expected_sha256:
+            logging.error("Checksum mismatch for %s: expected %s, got %s", output_file_path, expected_sha256, sha256)
+            os.remove(output_file_path)
+            return None
+        else:
+            logging.info("Checksum verified: %s", sha256)
+        
+        logging.info("Model downloaded successfully to: %s", output_file_path)
+        return str(output_file_path)
\ No newline at end of file
@@ -1,57 +1,202 @@
+import json
 import logging
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from safetensors.torch import load_file, save_file
+import torch
+from safetensors import safe_open
+
+# Bytes per element for each safetensors dtype
+SAFETENSORS_DTYPE_SIZES = {
+    "BOOL": 1, "U8": 1, "I8": 1, "F8_E5M2": 1, "F8_E4M3": 1,
+    "I16": 2, "U16": 2, "F16": 2, "BF16": 2,
+    "I32": 4, "U32": 4, "F32": 4,
+    "I64": 8, "U64": 8, "F64": 8,
+}
+
+# Components that can be extracted from a SDXL checkpoint
+COMPONENTS = ("unet", "clip_l", "clip_g", "vae")
+
+# Key prefixes of the SDXL text encoders and VAE inside a checkpoint
+EMBEDDERS_PREFIX = "conditioner.embedders."
+VAE_PREFIX = "first_stage_model."
+
+def classify_key(key):
+    """
+    Route a checkpoint key to its SDXL component.
+    
+    Returns:
+        Tuple of (component name, key to store it under in that component)
+    """
+    # Both text encoders share one prefix, so test it once and dispatch on the embedder index
+    if key.startswith(EMBEDDERS_PREFIX):
+        embedder = key[len(EMBEDDERS_PREFIX):len(EMBEDDERS_PREFIX) + 2]
+        if embedder == "0.":
+            return "clip_l", key
+        if embedder == "1.":
+            return "clip_g", key
+    elif key.startswith(VAE_PREFIX):
+        return "vae", key[len(VAE_PREFIX):]
+    return "unet", key
+
+def advise_file(path, *advice):
+    """
+    Pass posix_fadvise hints (e.g. "POSIX_FADV_WILLNEED") for a whole file.
+    
+    No-op on platforms without posix_fadvise; failures are only logged since
+    the hints never affect correctness.
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError as e:
+        logging.warning("Could not advise kernel about %s: %s", path, e)
+        return
+    try:
+        size = os.fstat(fd).st_size
+        for name in advice:
+            os.posix_fadvise(fd, 0, size, getattr(os, name))
+    except OSError as e:
+        logging.warning("Could not advise kernel about %s: %s", path, e)
+    finally:
+        os.close(fd)
 
 class ExtractComponents:
-    def __init__(self, model_path):
-        self.model_path = model_path
-        self.components_dir = Path(model_path).parent / "components"
+    def __init__(self, model_path, max_workers=4, drop_page_cache=True):
+        """
+        Args:
+            model_path: Path to the SDXL model file
+            max_workers: Number of components written concurrently (use 1 on a
+                single spinning disk)
+            drop_page_cache: Evict the checkpoint from the page cache after
+                extraction (disable when something else is still reading it)
+        """
+        # Absolute, so background extraction is unaffected by the llama.cpp setup changing directory
+        self.model_path = str(Path(model_path).resolve())
+        self.components_dir = Path(self.model_path).parent / "components"
         self.components_dir.mkdir(exist_ok=True)
+        self.max_workers = max(1, max_workers)
+        self.drop_page_cache = drop_page_cache
 
-    def extract_components(self, model_path):
-        """Extract UNet, CLIP_L, CLIP_G, and VAE from a SDXL model"""
-        logging.info(f"Loading checkpoint from: {model_path}")
-        state_dict = load_file(model_path)
+    def _save_component(self, model_path, key_map, output_path):
+        """
+        Copy the (source key, output key) pairs of the checkpoint into a standalone safetensors file.
         
-        filename_prefix = Path(model_path).stem
-        
-        # Extract UNet
-        clip_l_keys = [key for key in state_dict.keys() if key.startswith("conditioner.embedders.0.")]
-        clip_g_keys = [key for key in state_dict.keys() if key.startswith("conditioner.embedders.1.")]
-        vae_keys = [key for key in state_dict.keys() if key.startswith("first_stage_model.")]
-        excluded_keys = set(clip_l_keys + clip_g_keys + vae_keys)
-        unet_keys = [key for key in state_dict.keys() if key not in excluded_keys]
-        
-        unet_state_dict = {key: state_dict[key] for key in unet_keys}
-        unet_path = self.components_dir / f"{filename_prefix}_unet.safetensors"
-        logging.info(f"Saving UNet weights to: {unet_path}")
-        save_file(unet_state_dict, str(unet_path))
-        
-        # Extract CLIP_L
-        clip_l_state_dict = {key: state_dict[key] for key in clip_l_keys}
-        clip_l_path = self.components_dir / f"{filename_prefix}_clip_l.safetensors"
-        logging.info(f"Saving CLIP_L weights to: {clip_l_path}")
-        save_file(clip_l_state_dict, str(clip_l_path))
+        The header is built from the source tensor metadata and each tensor's
+        buffer is written straight to the file, so no full state dict or
+        intermediate bytes copy is held in memory.
+        """
+        # Each worker opens its own handle onto the memory-mapped checkpoint
+        with safe_open(model_path, framework="pt") as f:
+            header = {}
+            offset = 0
+            for src_key, dst_key in key_map:
+                tensor_slice = f.get_slice(src_key)
+                dtype = tensor_slice.get_dtype()
+                shape = tensor_slice.get_shape()
+                nbytes = SAFETENSORS_DTYPE_SIZES[dtype]
+                for dim in shape:
+                    nbytes *= dim
+                header[dst_key] = {"dtype": dtype, "shape": shape, "data_offsets": [offset, offset + nbytes]}
+                offset += nbytes
+            
+            # The header is padded with spaces so tensor data starts 8-byte aligned
+            header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+            header_bytes += b" " * (-len(header_bytes) % 8)
+            
+            with open(output_path, "wb") as out:
+                out.write(struct.pack("<Q", len(header_bytes)))
+                out.write(header_bytes)
+                for src_key, _ in key_map:
+                    tensor = f.get_tensor(src_key).contiguous()
+                    out.write(memoryview(tensor.reshape(-1).view(torch.uint8).numpy()))
+        return str(output_path)
+
+    def extract_components(self, model_path, components=COMPONENTS, ready_queue=None):
+        """
+        Extract UNet, CLIP_L, CLIP_G, and VAE from a SDXL model.
         
-        # Extract CLIP_G
-        clip_g_state_dict = {key: state_dict[key] for key in clip_g_keys}
-        clip_g_path = self.components_dir / f"{filename_prefix}_clip_g.safetensors"
-        logging.info(f"Saving CLIP_G weights to: {clip_g_path}")
-        save_file(clip_g_state_dict, str(clip_g_path))
+        Args:
+            model_path: Path to the SDXL model file
+            components: Names of the components to extract; tensors of the
+                others are never read from the checkpoint
+            ready_queue: Optional queue.Queue that receives a (name, path) tuple
+                as soon as each component is written, followed by None once
+                extraction has finished or failed, so later steps can start early
+            
+        Returns:
+            Mapping of component name to the path of its extracted file
+        """
+        # Whoever waits on ready_queue must hear about the end even if the
+        # components or the checkpoint turn out to be invalid
+        try:
+            unknown = set(components) - set(COMPONENTS)
+            if unknown:
+                raise ValueError(f"Unknown components: {', '.join(sorted(unknown))}")
+            
+            model_path = str(Path(model_path).resolve())
+            logging.info("Opening checkpoint from: %s", model_path)
+            
+            filename_prefix = Path(model_path).stem
+            
+            # The checkpoint is read front to back once: widen readahead and start paging it in now
+            advise_file(model_path, "POSIX_FADV_SEQUENTIAL", "POSIX_FADV_WILLNEED")
+            
+            # Tensors stay memory-mapped until their component is written
+            with safe_open(model_path, framework="pt") as f:
+                keys = list(f.keys())
+            
+            # Route every key to its component in a single pass, stripping the VAE prefix on the way
+            key_maps = {component: [] for component in COMPONENTS if component in components}
+            for key in keys:
+                component, dst_key = classify_key(key)
+                if component in key_maps:
+                    key_maps[component].append((key, dst_key))
+            
+            labels = {'unet': "UNet", 'clip_l': "CLIP_L", 'clip_g': "CLIP_G", 'vae': "VAE"}
+            jobs = {
+                name: (labels[name], key_map, self.components_dir / f"{filename_prefix}_{name}.safetensors")
+                for name, key_map in key_maps.items()
+            }
+            
+            # The components are disjoint, so they can be written concurrently. When
+            # someone is waiting on ready_queue, the UNet (by far the largest) is
+            # written on its own first so it is not the last to finish, and the
+            # smaller components are written behind it while the UNet is consumed
+            if ready_queue is not None and 'unet' in jobs:
+                stages = [['unet'], [name for name in jobs if name != 'unet']]
+            else:
+                stages = [list(jobs)]
+            
+            paths = {}
+            try:
+                with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                    for stage in stages:
+                        futures = {}
+                        for name in stage:
+                            label, key_map, output_path = jobs[name]
+                            logging.info("Saving %s weights to: %s", label, output_path)
+                            futures[pool.submit(self._save_component, model_path, key_map, output_path)] = name
+                        
+                        for future in as_completed(futures):
+                            name = futures[future]
+                            try:
+                                paths[name] = future.result()
+                            except Exception as e:
+                                logging.error("Failed to save %s weights: %s", jobs[name][0], e)
+                                raise
+                            if ready_queue is not None:
+                                ready_queue.put((name, paths[name]))
+            finally:
+                # None of the checkpoint is read again, so free that page cache for the written components
+                if self.drop_page_cache:
+                    advise_file(model_path, "POSIX_FADV_DONTNEED")
         
-        # Extract VAE
-        vae_state_dict = {
-            key.replace("first_stage_model.", ""): state_dict[key]
-            for key in vae_keys
-        }
-        vae_path = self.components_dir / f"{filename_prefix}_vae.safetensors"
-        logging.info(f"Saving VAE weights to: {vae_path}")
-        save_file(vae_state_dict, str(vae_path))
+        finally:
+            if ready_queue is not None:
+                ready_queue.put(None)
         
-        # Return paths to all extracted components
-        return {
-            'unet': str(unet_path),
-            'clip_l': str(clip_l_path),
-            'clip_g': str(clip_g_path),
-            'vae': str(vae_path)
-        }
\ No newline at end of file
+        # Return paths to all extracted components, in component order
+        return {name: paths[name] for name in jobs}
@@ -2,8 +2,10 @@
 import os
 import logging
 import argparse
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
-from extract_components import ExtractComponents
+from extract_components import ExtractComponents, COMPONENTS
 from convert_and_quantize import ConvertAndQuantize
 from setup_llama_cpp import SetupLLamaCpp
 from download_civitai import CivitaiDownloader
@@ -51,10 +53,11 @@ def show_steps():
 
 def get_model_info(model_path):
     """Display model information in a panel"""
-    if not os.path.exists(model_path):
+    try:
+        file_size = os.stat(model_path).st_size / (1024 * 1024 * 1024)  # Size in GB
+    except OSError:
         return
     
-    file_size = os.path.getsize(model_path) / (1024 * 1024 * 1024)  # Size in GB
     file_name = os.path.basename(model_path)
     
     table = Table(show_header=False, box=None)
@@ -68,11 +71,16 @@ def get_model_info(model_path):
     console.print(Panel(table, title="[bold yellow]Model Information[/bold yellow]", border_style="yellow"))
 
 def display_quantization_results(original_path, quantized_paths):
-    """Display a summary of the quantization results with size comparisons"""
-    if not os.path.exists(original_path):
+    """
+    Display a summary of the quantization results with size comparisons.
+    
+    quantized_paths maps the label of each quantization to its output file,
+    since file names such as <name>_Q4_K_S_mixed.gguf don't split cleanly.
+    """
+    try:
+        original_size = os.stat(original_path).st_size / (1024 * 1024)  # Size in MB
+    except OSError:
         original_size = 0
-    else:
-        original_size = os.path.getsize(original_path) / (1024 * 1024)  # Size in MB
     
     table = Table(show_header=True, header_style="bold magenta")
     table.add_column("Model Type", style="cyan")
@@ -81,12 +89,14 @@ def display_quantization_results(original_path, quantized_paths):
     
     table.add_row("Original Model", f"{original_size:.2f} MB", "100%")
     
-    for path in quantized_paths:
-        if os.path.exists(path):
-            size = os.path.getsize(path) / (1024 * 1024)
-            percentage = (size / original_size) * 100 if original_size > 0 else 0
-            quant_type = os.path.basename(path).split('_')[-1].replace('.gguf', '')
-            table.add_row(f"{quant_type}", f"{size:.2f} MB", f"{percentage:.1f}%")
+    for quant_type, path in quantized_paths.items():
+        # One stat() per file instead of an exists() check followed by getsize()
+        try:
+            size = os.stat(path).st_size / (1024 * 1024)
+        except OSError:
+            continue
+        percentage = (size / original_size) * 100 if original_size > 0 else 0
+        table.add_row(f"{quant_type}", f"{size:.2f} MB", f"{percentage:.1f}%")
     
     console.print(Panel(table, title="[bold yellow]Quantization Results[/bold yellow]", border_style="yellow"))
     console.print("\n")
@@ -113,6 +123,82 @@ def run_with_progress(task_description, function, *args, **kwargs):
             progress.update(task, status=f"Failed: {str(e)}")
             raise
 
+def run_parallel_with_progress(task_descriptions, function, max_workers):
+    """
+    Run a function concurrently for several argument tuples, with one progress row each.
+    
+    Args:
+        task_descriptions: Mapping of task description to the arguments for that call
+        function: Function to run for every task
+        max_workers: Maximum number of calls running at once
+        
+    Returns:
+        Mapping of task description to the function result (None if it raised)
+    """
+    results = {}
+    with Progress(
+        SpinnerColumn(),
+        TextColumn("[bold green]{task.description}"),
+        BarColumn(),
+        TextColumn("[bold yellow]{task.fields[status]}"),
+        TimeElapsedColumn(),
+        console=console
+    ) as progress, ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # Create one task per call
+        futures = {}
+        for description, args in task_descriptions.items():
+            task = progress.add_task(f"[cyan]{description}[/cyan]", total=None, status="Processing...")
+            futures[pool.submit(function, *args)] = (description, task)
+        
+        for future in as_completed(futures):
+            description, task = futures[future]
+            try:
+                results[description] = future.result()
+                progress.update(task, status="Complete!")
+            except Exception as e:
+                results[description] = None
+                progress.update(task, status=f"Failed: {str(e)}")
+    return results
+
+def start_in_background(function, *args):
+    """Start a function on a worker thread and return its future"""
+    pool = ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(function, *args)
+    # The worker keeps running; this only stops the pool from accepting more work
+    pool.shutdown(wait=False)
+    return future
+
+def wait_for_component(ready_queue, extraction, name):
+    """
+    Wait until a component written by a background extraction is ready.
+    
+    Returns:
+        Path to the component, or None if extraction finished without it
+    """
+    while True:
+        try:
+            item = ready_queue.get(timeout=1)
+        except queue.Empty:
+            # Everything the worker queues is queued before its future completes,
+            # so a finished worker with an empty queue has nothing more to send
+            if extraction.done() and ready_queue.empty():
+                extraction.result()  # Re-raise any extraction error
+                return None
+            continue
+        if item is None:
+            extraction.result()  # Re-raise any extraction error
+            return None
+        if item[0] == name:
+            return item[1]
+
+def finish_extraction(extraction):
+    """Wait for the components still being written in the background and report them"""
+    if extraction is None:
+        return
+    components = run_with_progress("Finishing extraction of remaining components", extraction.result)
+    if components:
+        console.print(f"[green]✓ Components extracted: [bold]{', '.join(components.values())}[/bold][/green]")
+
 def main():
     """
     Main entry point for the modular SDXL model processing pipeline.
@@ -138,15 +224,24 @@ def main():
     processing_group.add_argument("--skip_extract", action="store_true", help="Skip extraction and use existing UNet file")
     processing_group.add_argument("--unet_path", type=str, help="Path to existing UNet file (if skipping extraction)")
     processing_group.add_argument("--skip_setup", action="store_true", help="Skip llama.cpp setup (use if already set up)")
+    processing_group.add_argument("--force_setup", action="store_true", help="Remove and rebuild llama.cpp even if it is already set up")
     processing_group.add_argument("--skip_convert", action="store_true", help="Skip conversion and use existing GGUF file")
     processing_group.add_argument("--gguf_path", type=str, help="Path to existing GGUF file (if skipping conversion)")
+    processing_group.add_argument("--fused_convert", action="store_true",
+                      help="Convert the UNet straight from the checkpoint to GGUF without writing extracted components")
+    processing_group.add_argument("--components", type=str, nargs="+", choices=list(COMPONENTS),
+                      help="Components to extract (default: all; with --fused_convert: none besides the UNet GGUF)")
     
     # Quantization options
     quant_group = parser.add_argument_group("Quantization Options")
-    quant_group.add_argument("--skip_quant", action="store_true", help="Skip quantization and only generate F16 GGUF")
+    quant_group.add_argument("--skip_quant", action="store_true", help="Skip quantization and only generate the F16/BF16 GGUF")
     quant_group.add_argument("--quant_types", type=str, nargs="+", default=["Q5_K_S"],
                       choices=["Q4_K_S", "Q5_K_S", "Q8_0", "all"],
                       help="Quantization types to generate (use 'all' for all types)")
+    quant_group.add_argument("--sensitive_tensors", type=str,
+                      help="Comma-separated tensor=TYPE overrides kept at a different precision in a single "
+                           "mixed quantization pass, e.g. \"noise_refiner=BF16,time_embed=Q8_0\". Requires a "
+                           "llama.cpp build with --tensor-type-file (newer than the pinned release)")
     
     args = parser.parse_args()
     
@@ -173,6 +268,15 @@ def main():
     else:
         quant_types = args.quant_types
     
+    # Parse per-tensor quantization overrides
+    tensor_overrides = {}
+    if args.sensitive_tensors:
+        for override in args.sensitive_tensors.split(","):
+            pattern, sep, tensor_quant = override.strip().partition("=")
+            if not sep or not pattern or not tensor_quant:
+                parser.error(f"Invalid --sensitive_tensors entry '{override}', expected tensor=TYPE")
+            tensor_overrides[pattern] = tensor_quant
+    
     # Download from CivitAI if requested
     model_path = args.model_path
     if args.civitai:
@@ -207,35 +311,91 @@ def main():
     # Display model info if available
     if model_path:
         get_model_info(model_path)
+        # Absolute, since the llama.cpp setup changes directory while extraction
+        # may still be running in the background
+        model_path = str(Path(model_path).resolve())
+    
+    # Extraction and conversion run as one step when fused
+    fused_convert = args.fused_convert and not args.skip_extract and not args.skip_convert
     
     # Step 1: Extract components
     unet_path = args.unet_path
-    if not args.skip_extract:
+    gguf_path = args.gguf_path
+    # A single converter is shared by the conversion and quantization steps
+    converter = None
+    # Extraction still writing components in the background while conversion runs
+    extraction = None
+    if fused_convert:
+        console.print(Panel("[bold cyan]STEP 1-2: Converting UNet to GGUF Directly from Checkpoint[/bold cyan]", border_style="cyan"))
+        
+        # The UNet goes straight into the GGUF; write any other requested
+        # components from the same checkpoint at the same time
+        other_components = [name for name in (args.components or []) if name != "unet"]
+        if other_components:
+            # The fused conversion is still reading the checkpoint, so keep it cached
+            extractor = ExtractComponents(model_path, drop_page_cache=False)
+            extraction = start_in_background(extractor.extract_components, model_path, other_components)
+        
+        converter = ConvertAndQuantize(model_path)
+        gguf_path = run_with_progress(
+            "Converting UNet to GGUF format",
+            converter.fused_extract_and_convert,
+            model_path, not args.skip_setup, args.force_setup
+        )
+        finish_extraction(extraction)
+        
+        if gguf_path:
+            console.print(f"[green]✓ Conversion complete. GGUF saved to: [bold]{gguf_path}[/bold][/green]")
+        else:
+            console.print("[bold red]Conversion failed![/bold red]")
+            return
+    elif not args.skip_extract:
         console.print(Panel("[bold cyan]STEP 1: Extracting Model Components[/bold cyan]", border_style="cyan"))
         
         extractor = ExtractComponents(model_path)
-        components = run_with_progress(
-            "Extracting model components",
-            extractor.extract_components, 
-            model_path
-        )
+        requested_components = args.components or COMPONENTS
+        ready_queue = queue.Queue()
+        extraction = start_in_background(extractor.extract_components, model_path, requested_components, ready_queue)
         
-        unet_path = components['unet']
-        console.print(f"[green]✓ Components extracted. UNet saved to: [bold]{unet_path}[/bold][/green]")
+        if "unet" in requested_components and not args.skip_convert:
+            # Hand the UNet to conversion as soon as it is written while the
+            # remaining components keep writing in the background
+            unet_path = run_with_progress(
+                "Extracting UNet",
+                wait_for_component,
+                ready_queue, extraction, "unet"
+            )
+            console.print(f"[green]✓ UNet extracted to: [bold]{unet_path}[/bold][/green]")
+        else:
+            components = run_with_progress("Extracting model components", extraction.result)
+            extraction = None
+            
+            unet_path = components.get('unet')
+            if unet_path:
+                console.print(f"[green]✓ Components extracted. UNet saved to: [bold]{unet_path}[/bold][/green]")
+            else:
+                console.print(f"[green]✓ Components extracted: [bold]{', '.join(components.values())}[/bold][/green]")
+                # An existing GGUF can still be quantized without the UNet
+                if not gguf_path:
+                    console.print("[yellow]UNet was not extracted, skipping conversion and quantization.[/yellow]")
+                    console.print(Panel("[bold green]Processing pipeline complete![/bold green]", border_style="green"))
+                    return
     else:
         console.print(f"[yellow]Skipping extraction, using existing UNet: {unet_path}[/yellow]")
     
     # Step 2: Convert to GGUF
-    gguf_path = args.gguf_path
-    if not args.skip_convert and unet_path:
+    if fused_convert:
+        pass  # Already converted together with extraction
+    elif not args.skip_convert and unet_path:
         console.print(Panel("[bold cyan]STEP 2: Converting UNet to GGUF Format[/bold cyan]", border_style="cyan"))
         
         converter = ConvertAndQuantize(Path(unet_path).parent)
         gguf_path = run_with_progress(
             "Converting to GGUF format",
             converter.convert_to_gguf,
-            unet_path, not args.skip_setup
+            unet_path, not args.skip_setup, args.force_setup
         )
+        finish_extraction(extraction)
         
         if gguf_path:
             console.print(f"[green]✓ Conversion complete. GGUF saved to: [bold]{gguf_path}[/bold][/green]")
@@ -252,18 +412,46 @@ def main():
     if not args.skip_quant and gguf_path:
         console.print(Panel("[bold cyan]STEP 3: Quantizing GGUF Model[/bold cyan]", border_style="cyan"))
         
-        converter = ConvertAndQuantize(Path(gguf_path).parent)
-        quantized_paths = []
+        if converter is None:
+            converter = ConvertAndQuantize(Path(gguf_path).parent)
+        quantized_paths = {}
         
-        for quant_type in quant_types:
-            quantized_path = run_with_progress(
-                f"Quantizing to {quant_type}",
+        # Check once up front rather than failing every quant type the same way
+        if tensor_overrides:
+            try:
+                supported = converter.supports_mixed_quantization()
+            except FileNotFoundError as e:
+                console.print(f"[bold red]Cannot quantize: {e}[/bold red]")
+                return
+            if not supported:
+                console.print("[bold red]--sensitive_tensors needs a llama-quantize build with --tensor-type-file, "
+                              "which the pinned llama.cpp release does not have. Rebuild llama.cpp from a newer "
+                              "release or drop --sensitive_tensors.[/bold red]")
+                return
+        
+        # Each quantization is an independent llama-quantize process reading the
+        # same F16 file, so warm the page cache once and run them side by side
+        converter.prefetch_gguf(gguf_path)
+        max_workers = min(len(quant_types), max(1, (os.cpu_count() or 1) // 4))
+        if tensor_overrides:
+            # Sensitive tensors get their own type in the same pass as the bulk weights
+            results = run_parallel_with_progress(
+                {f"Quantizing to {quant_type}": (gguf_path, quant_type, tensor_overrides) for quant_type in quant_types},
+                converter.quantize_gguf_mixed,
+                max_workers
+            )
+        else:
+            results = run_parallel_with_progress(
+                {f"Quantizing to {quant_type}": (gguf_path, quant_type) for quant_type in quant_types},
                 converter.quantize_gguf,
-                gguf_path, quant_type
+                max_workers
             )
+        
+        for quant_type in quant_types:
+            quantized_path = results[f"Quantizing to {quant_type}"]
             
             if quantized_path:
-                quantized_paths.append(quantized_path)
+                quantized_paths[f"{quant_type} (mixed)" if tensor_overrides else quant_type] = quantized_path
                 console.print(f"[green]✓ Quantization to {quant_type} complete: [bold]{quantized_path}[/bold][/green]")
             else:
                 console.print(f"[bold red]Quantization to {quant_type} failed![/bold red]")
@@ -4,18 +4,69 @@ This module is responsible for setting up llama.cpp for GGUF conversion.
 
 import subprocess
 import os
+import shutil
 import logging
+from pathlib import Path
+
+# Pinned llama.cpp release and the patch applied on top of it
+LLAMA_CPP_TAG = "b3962"
+LLAMA_CPP_PATCH = "lcpp.patch"
+
+# Written once a build of the pinned tag and patch has succeeded
+SETUP_SENTINEL = os.path.join("llama.cpp", ".sushi_setup_ok")
+
+# Optimized build tuned for the host CPU, so the quantization kernels are vectorized
+CMAKE_BUILD_TYPE = "Release"
+CMAKE_FLAGS = [f"-DCMAKE_BUILD_TYPE={CMAKE_BUILD_TYPE}", "-DGGML_NATIVE=ON", "-DGGML_LTO=ON"]
 
 
 class SetupLLamaCpp:
-    def setup_llama_cpp(self):
-        """Set up llama.cpp for GGUF conversion"""
+    def _cmake_flags(self):
+        """CMake configure flags, adding AVX-512/VNNI when the host CPU reports them"""
+        flags = list(CMAKE_FLAGS)
+        try:
+            with open("/proc/cpuinfo") as f:
+                cpu_flags = set(f.read().split())
+        except OSError:
+            return flags
+        if "avx512f" in cpu_flags:
+            flags.append("-DGGML_AVX512=ON")
+            if "avx512_vnni" in cpu_flags:
+                flags.append("-DGGML_AVX512_VNNI=ON")
+        return flags
+
+    def _setup_id(self):
+        """Identifier of the pinned setup and build flags, recorded in the sentinel file"""
+        return f"{LLAMA_CPP_TAG}+{LLAMA_CPP_PATCH}+{' '.join(self._cmake_flags())}"
+
+    def is_setup(self):
+        """Check whether llama.cpp is already built for the pinned tag, patch and build flags"""
+        quantize_bins = ["llama.cpp/build/bin/llama-quantize", "llama.cpp/build/llama-quantize"]
+        if not any(os.path.exists(quantize_bin) for quantize_bin in quantize_bins):
+            return False
+        try:
+            return Path(SETUP_SENTINEL).read_text() == self._setup_id()
+        except OSError:
+            return False
+
+    def setup_llama_cpp(self, force=False):
+        """
+        Set up llama.cpp for GGUF conversion.
+        
+        Args:
+            force: Rebuild from a fresh clone even if llama.cpp is already set up
+        """
+        if not force and self.is_setup():
+            logging.info("llama.cpp %s already set up, skipping build", LLAMA_CPP_TAG)
+            return
+        
         logging.info("Setting up llama.cpp...")
         
         # Clone llama.cpp repository if it doesn't exist
         if os.path.exists("llama.cpp"):
-            # Remove the current version of llama.cpp in this directory
-            subprocess.run(["rm", "-rf", "llama.cpp"])
+            # Any existing checkout is not a verified build of the pinned tag and
+            # patch (it may carry an older patch or miss newer tags), so start clean
+            shutil.rmtree("llama.cpp", ignore_errors=True)
             logging.info("Removed existing llama.cpp directory")
 
         if not os.path.exists("llama.cpp"):
@@ -35,29 +86,25 @@ class SetupLLamaCpp:
             logging.info("Installing gguf-py...")
             subprocess.run(["pip", "install", "./gguf-py"], check=True)
         
-        # Change directory to llama.cpp
-        try:
-            subprocess.run(["cd", "llama.cpp"], check=True)
-        except Exception as e:
-            logging.warning("Can't change directory to llama.cpp")
-        
         # Download conversion script and patch
         logging.info("Downloading conversion script and patch...")
         subprocess.run(["wget", "-O", "convert.py", 
                       "https://raw.githubusercontent.com/city96/ComfyUI-GGUF/main/tools/convert.py"], check=True)
         subprocess.run(["wget", "-O", "convert_g.py", 
                       "https://huggingface.co/Old-Fisherman/SDXL_Finetune_GGUF_Files/resolve/main/convert_g.py"], check=True)
-        subprocess.run(["wget", "-O", "lcpp.patch", 
+        subprocess.run(["wget", "-O", LLAMA_CPP_PATCH, 
                       "https://raw.githubusercontent.com/city96/ComfyUI-GGUF/main/tools/lcpp.patch"], check=True)
         
         # Apply the patch (make non-fatal)
         logging.info("Applying patch to llama.cpp...")
+        patched = False
         try:
-            subprocess.run(["git", "checkout", "tags/b3962"], check=True)
+            subprocess.run(["git", "checkout", f"tags/{LLAMA_CPP_TAG}"], check=True)
             # Try to apply the patch, but don't error if it fails
-            subprocess.run(["git", "apply", "lcpp.patch"],  check=True)
+            subprocess.run(["git", "apply", LLAMA_CPP_PATCH],  check=True)
+            patched = True
         except Exception as e:
-            logging.warning(f"Error during patching: {e}")
+            logging.warning("Error during patching: %s", e)
             logging.warning("Continuing without patch. This may affect compatibility.")
         
         # Build the project
@@ -68,13 +115,20 @@ class SetupLLamaCpp:
             logging.info("Trying CMake build .. ")
             os.makedirs("build", exist_ok=True)
             os.chdir("build")
-            subprocess.run(["cmake", ".."], check=True)
-            subprocess.run(["cmake", "--build", ".", "--config", "Debug", "-j10", "--target", "llama-quantize"], check=True)
+            subprocess.run(["cmake", ".."] + self._cmake_flags(), check=True)
+            subprocess.run(["cmake", "--build", ".", "--config", CMAKE_BUILD_TYPE, "-j10", "--target", "llama-quantize"], check=True)
             os.chdir("..")
         except subprocess.CalledProcessError as e2:
-            logging.error(f"CMake build also failed: {e2}")
+            logging.error("CMake build also failed: %s", e2)
             raise RuntimeError("Failed to build llama.cpp using both make and CMake")
         
         # Return to original directory
         os.chdir(original_dir)
+        
+        # Record the build so later runs can skip it, but only if it really is
+        # the pinned tag with the patch applied
+        if patched:
+            Path(SETUP_SENTINEL).write_text(self._setup_id())
+        else:
+            logging.warning("llama.cpp was not built from the patched %s tag; it will be set up again next run", LLAMA_CPP_TAG)
         logging.info("llama.cpp setup complete")